@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the Multi-Layer Manager actions against the in-memory PDB
+stand-in, reporting wall time, PDB call counts, undo memory and Layers
+dock updates per action.
+
+    python benchmarks/bench_actions.py
+    python benchmarks/bench_actions.py --sizes 10000 --actions move_up,merge
+    python benchmarks/bench_actions.py --json after.json --compare before.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fz_multi_layer_manager as mlm
+from fake_gimp import FakeGimp, FakeGroupLayer, FakeImage, FakeLayer, FakePdb
+
+# Which layers in display order are selected: every tenth ("spread"), or
+# runs of ten out of every hundred ("blocks")
+SELECTIONS = {
+    'spread': lambda number: number % 10 == 0,
+    'blocks': lambda number: number % 100 < 10,
+}
+
+def build_flat(pdb, count):
+    """An image with count layers at the top level."""
+    image = FakeImage(pdb)
+    for number in range(count):
+        image.add(FakeLayer(image, "Layer %d" % number, 256, 256, (number % 64, number % 48)))
+    return image
+
+def build_nested(pdb, count, depth=32):
+    """An image whose count layers are spread over a chain of depth nested groups."""
+    image = FakeImage(pdb)
+    depth = min(depth, count)
+    per_level = max(1, count // depth)
+    parent = None
+    made = 0
+    for level in range(depth):
+        group = image.add(FakeGroupLayer(image, "Group %d" % level, 256, 256), parent)
+        for number in range(per_level):
+            if made >= count:
+                break
+            image.add(FakeLayer(image, "Layer %d.%d" % (level, number), 256, 256), group)
+            made += 1
+        parent = group
+    return image
+
+SHAPES = [("flat", build_flat), ("nested", build_nested)]
+
+def layers_of(nodes):
+    return [node.layer for node in nodes]
+
+def in_transaction(action, **options):
+    """action run as the dialog runs it: inside an UndoTransaction with options, then one flush."""
+    def run(pdb, image, index, nodes):
+        with mlm.UndoTransaction(pdb, image, **options):
+            result = action(pdb, image, index, nodes)
+        mlm.gimp.displays_flush()
+        return result
+    return run
+
+def warmed(new_cache, action):
+    """
+    action(pdb, image, index, nodes, cache) timed on a second pass over an
+    unchanged tree: run_action calls its warm_up, the first pass filling a
+    fresh new_cache(), before it starts the clock.
+    """
+    cache = [None]
+    
+    def warm_up(pdb, image, index, nodes):
+        cache[0] = new_cache()
+        action(pdb, image, index, nodes, cache[0])
+    
+    def run(pdb, image, index, nodes):
+        return action(pdb, image, index, nodes, cache[0])
+    run.warm_up = warm_up
+    return run
+
+def offset(pdb, image, index, nodes):
+    return mlm.offset_layers(pdb, layers_of(nodes), 10, -5)
+
+def visibility(pdb, image, index, nodes):
+    return mlm.toggle_visibility(pdb, layers_of(nodes))
+
+def opacity(pdb, image, index, nodes):
+    return mlm.set_opacity(pdb, layers_of(nodes), 50.0)
+
+def scale_half(pdb, image, index, nodes):
+    return mlm.scale_layers(pdb, mlm.scale_targets(pdb, layers_of(nodes), "50%", "50%", True))
+
+# Each action receives (pdb, image, index, selected nodes)
+ACTIONS = [
+    ("index", lambda pdb, image, index, nodes: mlm.LayerIndex(image)),
+    ("index_full", lambda pdb, image, index, nodes: list(mlm.LayerIndex(image).walk())),
+    ("selection", lambda pdb, image, index, nodes: index.selected_nodes()),
+    ("duplicate", lambda pdb, image, index, nodes: mlm.duplicate_layers(pdb, image, index, nodes)),
+    ("repeat_10", lambda pdb, image, index, nodes: mlm.repeat_layers(pdb, image, index, nodes, 10, 32, 0)),
+    ("delete", lambda pdb, image, index, nodes: mlm.delete_layers(pdb, image, nodes)),
+    ("move_up", lambda pdb, image, index, nodes: mlm.reorder_layers(pdb, image, index, nodes, 'up')),
+    ("move_down", lambda pdb, image, index, nodes: mlm.reorder_layers(pdb, image, index, nodes, 'down')),
+    ("move_up_5", lambda pdb, image, index, nodes: mlm.reorder_layers(pdb, image, index, nodes, 'up', 5)),
+    ("move_top", lambda pdb, image, index, nodes: mlm.reorder_layers(pdb, image, index, nodes, 'top')),
+    ("move_bottom", lambda pdb, image, index, nodes: mlm.reorder_layers(pdb, image, index, nodes, 'bottom')),
+    ("offset", offset),
+    ("offset_frozen", in_transaction(offset, freeze_layers=True)),
+    ("visibility", visibility),
+    ("visibility_frozen", in_transaction(visibility, freeze_layers=True)),
+    ("group", lambda pdb, image, index, nodes: mlm.group_layers(pdb, image, layers_of(nodes))),
+    ("merge", lambda pdb, image, index, nodes: mlm.merge_layers(pdb, image, index, nodes)),
+    ("opacity", opacity),
+    ("opacity_frozen", in_transaction(opacity, freeze_layers=True)),
+    ("opacity_planned", lambda pdb, image, index, nodes: planned_writes(pdb, index, nodes, {'opacity': 50.0})),
+    ("opacity_noop", lambda pdb, image, index, nodes: mlm.set_opacity(pdb, layers_of(nodes), 100.0)),
+    ("opacity_noop_planned", lambda pdb, image, index, nodes: planned_writes(pdb, index, nodes, {'opacity': 100.0})),
+    ("blend_mode", lambda pdb, image, index, nodes: mlm.set_blend_mode(pdb, layers_of(nodes), 3)),
+    ("scale", scale_half),
+    ("scale_fast", in_transaction(scale_half, frozen=True)),
+    ("scale_unit", lambda pdb, image, index, nodes: mlm.scale_layers_as_unit(
+        pdb, mlm.unit_scale_targets(pdb, layers_of(nodes), "50%", "50%", True))),
+    ("rotate", lambda pdb, image, index, nodes: mlm.rotate_layers(pdb, layers_of(nodes), 30.0)),
+    ("trim", lambda pdb, image, index, nodes: mlm.trim_layers(pdb, layers_of(nodes))),
+    ("rotate_90", lambda pdb, image, index, nodes: mlm.rotate_layers(pdb, layers_of(nodes), 90.0)),
+    ("paste_effects", lambda pdb, image, index, nodes: mlm.paste_effects(
+        pdb, layers_of(nodes), {'opacity': 40.0, 'mode': 4, 'visible': False})),
+    ("scale_chunked", lambda pdb, image, index, nodes: mlm.ChunkedAction(
+        "Scale", mlm.scale_layers, mlm.scale_targets(pdb, layers_of(nodes), "50%", "50%", True)).run(pdb)),
+    ("memory", lambda pdb, image, index, nodes: [mlm.node_memory(pdb, index, node, {}) for node in index.roots]),
+    ("snapshot", lambda pdb, image, index, nodes: mlm.PropertySnapshot(pdb, index)),
+    ("query", lambda pdb, image, index, nodes: mlm.PropertySnapshot(pdb, index).query(
+        "!hidden opacity>=50 'Layer *1' !in:'Group 3*' depth<8")),
+    ("macro", lambda pdb, image, index, nodes: mlm.replay_macro(pdb, image, MACRO)),
+    ("macro_fast", in_transaction(lambda pdb, image, index, nodes: mlm.replay_macro(pdb, image, MACRO), frozen=True)),
+    ("export", lambda pdb, image, index, nodes: export(pdb, image, nodes, trim=True)),
+    ("export_serial", lambda pdb, image, index, nodes: export(pdb, image, nodes, trim=True, workers=1)),
+    ("thumbs_cold", lambda pdb, image, index, nodes: thumbnails(pdb, image, index, mlm.ThumbnailCache())),
+    ("thumbs_warm", warmed(mlm.ThumbnailCache, lambda pdb, image, index, nodes, cache:
+                           thumbnails(pdb, image, index, cache))),
+    ("duplicates_cold", lambda pdb, image, index, nodes: mlm.find_duplicate_content(
+        pdb, image, list(index.walk()), mlm.ContentHashCache())),
+    ("duplicates_warm", warmed(mlm.ContentHashCache, lambda pdb, image, index, nodes, cache:
+                               mlm.find_duplicate_content(pdb, image, list(index.walk()), cache))),
+]
+
+# A typical sequence: select by name, set blend mode and opacity, move and group
+MACRO = {'steps': [
+    {'select': "'Layer *1'"},
+    {'mode': "Multiply"},
+    {'opacity': 60},
+    {'move': [10, -5]},
+    {'group': "Grouped"},
+]}
+
+def planned_writes(pdb, index, nodes, values):
+    """Write values to nodes through the planner, skipping unchanged ones."""
+    plan, skipped = mlm.plan_property_writes(mlm.PropertySnapshot(pdb, index), nodes, values)
+    mlm.apply_property_writes(pdb, plan)
+
+def export(pdb, image, nodes, **options):
+    """Export nodes to PNG files in a temporary directory."""
+    directory = tempfile.mkdtemp()
+    try:
+        mlm.export_layers(pdb, image, layers_of(nodes), directory, **options)
+    finally:
+        shutil.rmtree(directory)
+
+def thumbnails(pdb, image, index, cache):
+    """Thumbnails for every layer in the tree, through cache."""
+    for node in index.walk():
+        mlm.cached_thumbnail(pdb, cache, image, node)
+
+def run_action(build, count, action, selection='spread'):
+    """Time one action on a freshly built image, after its warm_up if it has one."""
+    pdb = FakePdb()
+    mlm.gimp = FakeGimp(pdb)
+    image = build(pdb, count)
+    index = mlm.LayerIndex(image)
+    all_nodes = list(index.walk())
+    for number, node in enumerate(all_nodes):
+        if SELECTIONS[selection](number):
+            index.select(node, True)
+    nodes = index.selected_nodes()
+    warm_up = getattr(action, 'warm_up', None)
+    if warm_up is not None:
+        warm_up(pdb, image, index, nodes)
+    
+    pdb.reset()
+    error = None
+    start = time.time()
+    try:
+        action(pdb, image, index, nodes)
+    except Exception as e:
+        error = "%s: %s" % (type(e).__name__, e)
+    seconds = time.time() - start
+    
+    top = sorted(pdb.calls.items(), key=lambda item: -item[1])[:3]
+    return {
+        'layers': len(all_nodes),
+        'selected': len(nodes),
+        'seconds': seconds,
+        'pdb_calls': pdb.total_calls(),
+        'undo_bytes': pdb.undo_bytes,
+        'dock_updates': pdb.calls['layers_dock_update'],
+        'top_calls': top,
+        'error': error,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="10,1000,10000", help="comma separated layer counts")
+    parser.add_argument("--shapes", default="flat,nested", help="comma separated tree shapes")
+    parser.add_argument("--actions", default="", help="comma separated action names (default all)")
+    parser.add_argument("--selection", default="spread", choices=sorted(SELECTIONS),
+                        help="every tenth layer, or runs of ten per hundred")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="results file of an earlier run to compare with")
+    args = parser.parse_args()
+    
+    sizes = [int(size) for size in args.sizes.split(",")]
+    shapes = [shape for shape in SHAPES if shape[0] in args.shapes.split(",")]
+    wanted = [name for name in args.actions.split(",") if name]
+    actions = [action for action in ACTIONS if not wanted or action[0] in wanted]
+    
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    
+    results = {}
+    print("%-8s %6s %-17s %10s %9s %9s %7s  %s" % (
+        "tree", "layers", "action", "seconds", "pdb", "undo MB", "dock", "top procedures"))
+    for shape_name, build in shapes:
+        for count in sizes:
+            for action_name, action in actions:
+                key = "%s/%d/%s/%s" % (shape_name, count, args.selection, action_name)
+                result = results[key] = run_action(build, count, action, args.selection)
+                line = "%-8s %6d %-17s %10.4f %9d %9.1f %7d  %s" % (
+                    shape_name, result['layers'], action_name, result['seconds'], result['pdb_calls'],
+                    result['undo_bytes'] / 1048576.0, result['dock_updates'],
+                    ", ".join("%s=%d" % item for item in result['top_calls']))
+                if key in baseline:
+                    before = baseline[key]
+                    line += "  (was %.4fs, %d calls)" % (before['seconds'], before['pdb_calls'])
+                if result['error']:
+                    line += "  ERROR %s" % result['error']
+                print(line)
+    
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
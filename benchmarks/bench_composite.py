@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the NumPy compositor: time to composite a stack of random
+layers with each supported blend mode, at full size and as a preview.
+
+    python benchmarks/bench_composite.py --size 2048 --layers 8
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import fz_multi_layer_manager as mlm
+
+def random_stack(count, size, step=1):
+    """count half-transparent layers of size x size pixels, staggered."""
+    random = mlm.numpy.random.RandomState(0)
+    stack = []
+    for number in range(count):
+        pixels = random.rand(size // step, size // step, 4).astype(mlm.numpy.float32)
+        offset = (number * 16 // step, number * 8 // step)
+        stack.append((pixels, offset, 0.8, "Normal"))
+    return stack
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=2048, help="layer and canvas side in pixels")
+    parser.add_argument("--layers", type=int, default=8, help="layers in the stack")
+    args = parser.parse_args()
+    
+    if mlm.numpy is None:
+        sys.exit("NumPy is not installed")
+    
+    step = max(1, args.size // mlm.PREVIEW_SIZE)
+    full = random_stack(args.layers, args.size)
+    preview = random_stack(args.layers, args.size, step)
+    
+    print("%-14s %12s %12s" % ("mode", "full (s)", "preview (ms)"))
+    for mode_name, mode_value in mlm.BLEND_MODES:
+        start = time.time()
+        mlm.composite_layers(full, args.size, args.size, mode_name)
+        full_seconds = time.time() - start
+        
+        start = time.time()
+        mlm.composite_layers(preview, args.size // step, args.size // step, mode_name)
+        preview_seconds = time.time() - start
+        print("%-14s %12.3f %12.1f" % (mode_name, full_seconds, preview_seconds * 1000))
+
+if __name__ == "__main__":
+    main()
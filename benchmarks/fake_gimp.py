@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-memory stand-in for the parts of GIMP's PDB the Multi-Layer Manager
+uses, so its layer actions can be measured without a running GIMP.
+
+Every PDB procedure call, and every property read on an item (which
+costs a PDB round-trip in gimpfu too), is counted in FakePdb.calls.
+Undo memory is estimated in FakePdb.undo_bytes: each change to an image
+whose undo is not frozen costs UNDO_STEP_BYTES, plus the old pixels
+(4 bytes per pixel) when it replaces or drops a layer's pixels. Each
+change made while the image's layers are not frozen also counts a
+'layers_dock_update', as would GIMP's Layers dock following it.
+"""
+
+import collections
+import itertools
+import math
+
+# Bookkeeping of one undo step, without pixel data
+UNDO_STEP_BYTES = 256
+
+class FakeItem(object):
+    """A layer or layer group belonging to a FakeImage."""
+    
+    _ids = itertools.count(1)
+    
+    def __init__(self, image, name, width, height, offsets=(0, 0)):
+        self.ID = next(self._ids)
+        self._image = image
+        self._name = name
+        self._tattoo = image._next_tattoo()
+        self._width = width
+        self._height = height
+        self._offsets = tuple(offsets)
+        self._visible = True
+        self._opacity = 100.0
+        self._mode = 0
+        self._parent = None
+        self._valid = True
+        self._retouch = 0  # Set to change the first pixel without changing the thumbnail
+    
+    def _touch(self, procedure):
+        self._image.pdb.calls[procedure] += 1
+    
+    def __repr__(self):
+        return "<%s %r>" % (type(self).__name__, self._name)
+    
+    @property
+    def name(self):
+        self._touch('gimp_item_get_name')
+        return self._name
+    
+    @property
+    def tattoo(self):
+        self._touch('gimp_item_get_tattoo')
+        return self._tattoo
+    
+    @property
+    def visible(self):
+        self._touch('gimp_item_get_visible')
+        return self._visible
+    
+    @property
+    def opacity(self):
+        self._touch('gimp_layer_get_opacity')
+        return self._opacity
+    
+    @property
+    def mode(self):
+        self._touch('gimp_layer_get_mode')
+        return self._mode
+    
+    @property
+    def offsets(self):
+        self._touch('gimp_drawable_offsets')
+        return self._offsets
+    
+    @property
+    def width(self):
+        self._touch('gimp_drawable_width')
+        return self._width
+    
+    @property
+    def height(self):
+        self._touch('gimp_drawable_height')
+        return self._height
+    
+    def get_pixel_rgn(self, x, y, width, height, dirty, shadow):
+        self._image.pdb.calls['pixel_rgn'] += 1
+        return FakeRegion(self)
+    
+    def _copy(self, image):
+        copy = type(self)(image, self._name + " copy", self._width, self._height, self._offsets)
+        copy._visible = self._visible
+        copy._opacity = self._opacity
+        copy._mode = self._mode
+        return copy
+
+class FakeRegion(object):
+    """Read-only pixel region: RGBA, transparent but for an opaque middle half."""
+    
+    def __init__(self, item):
+        self._item = item
+    
+    def __getitem__(self, key):
+        columns, rows = key
+        width, height = self._item._width, self._item._height
+        blank = b"\x00\x00\x00\x00" * width
+        filled = blank[:width] + b"\x80\x80\x80\xff" * (width // 2) + blank[:(width - width // 2) * 4 - width]
+        data = b"".join(filled if height // 4 <= y < height * 3 // 4 else blank
+                        for y in range(rows.start, rows.stop))
+        if self._item._retouch and rows.start == 0 and data:
+            data = bytearray(data)
+            data[0] = self._item._retouch % 256
+            data = bytes(data)
+        return data
+
+class FakeLayer(FakeItem):
+    pass
+
+class FakeGroupLayer(FakeItem):
+    
+    def __init__(self, image, name, width=0, height=0, offsets=(0, 0)):
+        FakeItem.__init__(self, image, name, width, height, offsets)
+        self._children = []
+    
+    @property
+    def layers(self):
+        self._touch('gimp_item_get_children')
+        return list(self._children)
+    
+    children = layers
+    
+    def _copy(self, image):
+        copy = FakeItem._copy(self, image)
+        for child in self._children:
+            child_copy = child._copy(image)
+            child_copy._parent = copy
+            copy._children.append(child_copy)
+        return copy
+
+class FakeImage(object):
+    
+    _ids = itertools.count(1)
+    
+    def __init__(self, pdb, width=1920, height=1080):
+        self.ID = next(self._ids)
+        self.pdb = pdb
+        self.base_type = 0  # RGB
+        self._width = width
+        self._height = height
+        self._top = []
+        self._tattoos = itertools.count(1)
+        self._undo_frozen = 0
+        self._layers_frozen = 0
+    
+    def _next_tattoo(self):
+        return next(self._tattoos)
+    
+    @property
+    def name(self):
+        self.pdb.calls['gimp_image_get_name'] += 1
+        return "Untitled-%d" % self.ID
+    
+    @property
+    def layers(self):
+        self.pdb.calls['gimp_image_get_layers'] += 1
+        return list(self._top)
+    
+    @property
+    def width(self):
+        return self._width
+    
+    @property
+    def height(self):
+        return self._height
+    
+    def _container(self, parent):
+        if parent is None:
+            return self._top
+        return parent._children
+    
+    def add(self, item, parent=None):
+        """Append item below the existing items of parent without counting."""
+        item._parent = parent
+        self._container(parent).append(item)
+        return item
+
+class FakeGimp(object):
+    """Stand-in for the gimp module."""
+    
+    GroupLayer = FakeGroupLayer
+    
+    def __init__(self, pdb):
+        self.pdb = pdb
+    
+    def displays_flush(self):
+        self.pdb.calls['gimp.displays_flush'] += 1
+
+class FakePdb(object):
+    """
+    Stand-in for gimpfu's pdb. Procedures live as gimp_* methods; calling
+    one through the instance counts it. Unknown procedures raise
+    AttributeError, like the real pdb.
+    """
+    
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.undo_depth = 0
+        self.undo_bytes = 0
+        self._context = [{'interpolation': 2}]
+    
+    def __getattribute__(self, name):
+        attr = object.__getattribute__(self, name)
+        if not name.startswith('gimp_'):
+            return attr
+        calls = object.__getattribute__(self, 'calls')
+        
+        def procedure(*args):
+            calls[name] += 1
+            return attr(*args)
+        return procedure
+    
+    def reset(self):
+        self.calls.clear()
+        self.undo_bytes = 0
+    
+    def total_calls(self):
+        return sum(count for name, count in self.calls.items() if name.startswith('gimp_'))
+    
+    # Undo
+    
+    def gimp_image_undo_group_start(self, image):
+        self.undo_depth += 1
+    
+    def gimp_image_undo_group_end(self, image):
+        self.undo_depth -= 1
+    
+    def gimp_image_undo_freeze(self, image):
+        image._undo_frozen += 1
+        return True
+    
+    def gimp_image_undo_thaw(self, image):
+        image._undo_frozen -= 1
+        return True
+    
+    def gimp_image_freeze_layers(self, image):
+        image._layers_frozen += 1
+    
+    def gimp_image_thaw_layers(self, image):
+        image._layers_frozen -= 1
+        if not image._layers_frozen:
+            self.calls['layers_dock_update'] += 1  # Rebuilt once
+    
+    def _changed(self, item, pixels=False):
+        """
+        Account for the undo step of a change to item, keeping its old
+        pixels if pixels, and for the Layers dock following the change.
+        """
+        if not item._image._layers_frozen:
+            self.calls['layers_dock_update'] += 1
+        if not item._image._undo_frozen:
+            self.undo_bytes += UNDO_STEP_BYTES
+            if pixels:
+                self.undo_bytes += item._width * item._height * 4
+    
+    # Tree structure
+    
+    def _check(self, item):
+        if not item._valid:
+            raise RuntimeError("Procedure called with an invalid item %r" % item)
+    
+    def gimp_item_is_valid(self, item):
+        return item._valid
+    
+    def gimp_image_get_item_position(self, image, item):
+        self._check(item)
+        return image._container(item._parent).index(item)
+    
+    def gimp_image_insert_layer(self, image, layer, parent, position):
+        container = image._container(parent)
+        self._changed(layer)
+        if position < 0:
+            position = 0
+        layer._parent = parent
+        container.insert(min(position, len(container)), layer)
+    
+    def gimp_image_remove_layer(self, image, layer):
+        self._check(layer)
+        self._changed(layer, pixels=True)
+        image._container(layer._parent).remove(layer)
+        self._invalidate(layer)
+    
+    def _invalidate(self, item):
+        item._valid = False
+        for child in getattr(item, '_children', ()):
+            self._invalidate(child)
+    
+    def gimp_image_reorder_item(self, image, item, parent, position):
+        self._check(item)
+        self._changed(item)
+        image._container(item._parent).remove(item)
+        container = image._container(parent)
+        item._parent = parent
+        container.insert(max(0, min(position, len(container))), item)
+    
+    def gimp_layer_copy(self, layer, add_alpha):
+        self._check(layer)
+        return layer._copy(layer._image)
+    
+    def gimp_layer_group_new(self, image):
+        return FakeGroupLayer(image, "Layer Group")
+    
+    def gimp_image_merge_down(self, image, layer, merge_type):
+        self._check(layer)
+        container = image._container(layer._parent)
+        position = container.index(layer)
+        if position + 1 >= len(container):
+            raise RuntimeError("There is no visible layer to merge down to")
+        below = container[position + 1]
+        self._changed(layer, pixels=True)
+        self._changed(below, pixels=True)
+        x0 = min(layer._offsets[0], below._offsets[0])
+        y0 = min(layer._offsets[1], below._offsets[1])
+        x1 = max(layer._offsets[0] + layer._width, below._offsets[0] + below._width)
+        y1 = max(layer._offsets[1] + layer._height, below._offsets[1] + below._height)
+        merged = FakeLayer(image, below._name, x1 - x0, y1 - y0, (x0, y0))
+        merged._parent = layer._parent
+        container[position:position + 2] = [merged]
+        self._invalidate(layer)
+        self._invalidate(below)
+        return merged
+    
+    def gimp_image_merge_layer_group(self, image, group):
+        self._check(group)
+        self._changed(group, pixels=True)
+        children = group._children
+        if children:
+            x0 = min(child._offsets[0] for child in children)
+            y0 = min(child._offsets[1] for child in children)
+            x1 = max(child._offsets[0] + child._width for child in children)
+            y1 = max(child._offsets[1] + child._height for child in children)
+        else:
+            x0, y0, x1, y1 = 0, 0, 0, 0
+        merged = FakeLayer(image, group._name, x1 - x0, y1 - y0, (x0, y0))
+        merged._parent = group._parent
+        container = image._container(group._parent)
+        container[container.index(group)] = merged
+        self._invalidate(group)
+        return merged
+    
+    # Properties
+    
+    def gimp_item_get_name(self, item):
+        return item._name
+    
+    def gimp_item_set_name(self, item, name):
+        self._changed(item)
+        item._name = name
+    
+    def gimp_item_get_tattoo(self, item):
+        return item._tattoo
+    
+    def gimp_item_get_visible(self, item):
+        self._check(item)
+        return item._visible
+    
+    def gimp_item_set_visible(self, item, visible):
+        self._check(item)
+        self._changed(item)
+        item._visible = bool(visible)
+    
+    def gimp_layer_get_opacity(self, layer):
+        self._check(layer)
+        return layer._opacity
+    
+    def gimp_layer_set_opacity(self, layer, opacity):
+        self._check(layer)
+        self._changed(layer)
+        layer._opacity = float(opacity)
+    
+    def gimp_layer_get_mode(self, layer):
+        self._check(layer)
+        return layer._mode
+    
+    def gimp_layer_set_mode(self, layer, mode):
+        self._check(layer)
+        self._changed(layer)
+        layer._mode = mode
+    
+    def gimp_drawable_width(self, drawable):
+        return drawable._width
+    
+    def gimp_drawable_height(self, drawable):
+        return drawable._height
+    
+    def gimp_drawable_offsets(self, drawable):
+        return drawable._offsets
+    
+    def gimp_drawable_bpp(self, drawable):
+        return 4
+    
+    def gimp_drawable_has_alpha(self, drawable):
+        return True
+    
+    def gimp_layer_get_mask(self, layer):
+        return None
+    
+    def gimp_drawable_thumbnail(self, drawable, width, height):
+        scale = min(1.0, float(width) / max(1, drawable._width), float(height) / max(1, drawable._height))
+        width = max(1, int(drawable._width * scale))
+        height = max(1, int(drawable._height * scale))
+        return width, height, 4, width * height * 4, (0,) * (width * height * 4)
+    
+    # Context
+    
+    def gimp_context_push(self):
+        self._context.append(dict(self._context[-1]))
+    
+    def gimp_context_pop(self):
+        self._context.pop()
+    
+    def gimp_context_set_interpolation(self, interpolation):
+        self._context[-1]['interpolation'] = interpolation
+    
+    # Geometry
+    
+    def gimp_layer_set_offsets(self, layer, x, y):
+        self._check(layer)
+        self._changed(layer)
+        layer._offsets = (x, y)
+    
+    def gimp_layer_scale(self, layer, width, height, local_origin):
+        self._check(layer)
+        self._changed(layer, pixels=True)
+        if local_origin:
+            x, y = layer._offsets
+            layer._offsets = (x + (layer._width - width) // 2, y + (layer._height - height) // 2)
+        layer._width = width
+        layer._height = height
+    
+    def gimp_layer_resize(self, layer, width, height, offset_x, offset_y):
+        self._check(layer)
+        self._changed(layer, pixels=True)
+        x, y = layer._offsets
+        layer._offsets = (x - offset_x, y - offset_y)
+        layer._width = width
+        layer._height = height
+    
+    def gimp_item_transform_scale(self, item, x0, y0, x1, y1):
+        self._check(item)
+        self._changed(item, pixels=True)
+        item._offsets = (int(round(x0)), int(round(y0)))
+        item._width = int(round(x1 - x0))
+        item._height = int(round(y1 - y0))
+        return item
+    
+    def gimp_item_transform_rotate_simple(self, item, rotate_type, auto_center, center_x, center_y):
+        self._check(item)
+        self._changed(item, pixels=True)
+        if rotate_type != 1:  # 90 or 270 degrees swap the sides around the center
+            x, y = item._offsets
+            center_x = x + item._width / 2.0
+            center_y = y + item._height / 2.0
+            item._width, item._height = item._height, item._width
+            item._offsets = (int(center_x - item._width / 2.0), int(center_y - item._height / 2.0))
+        return item
+    
+    def gimp_item_transform_flip_simple(self, item, flip_type, auto_center, axis):
+        self._check(item)
+        self._changed(item, pixels=True)
+        return item
+    
+    def gimp_item_transform_rotate(self, item, angle, auto_center, center_x, center_y):
+        self._check(item)
+        self._changed(item, pixels=True)
+        cos_a = abs(math.cos(angle))
+        sin_a = abs(math.sin(angle))
+        width = item._width * cos_a + item._height * sin_a
+        height = item._width * sin_a + item._height * cos_a
+        item._width = int(math.ceil(width))
+        item._height = int(math.ceil(height))
+        item._offsets = (int(center_x - width / 2.0), int(center_y - height / 2.0))
+        return item
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+"""Checks of the headless batch operations against the PDB stand-in in benchmarks/."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "benchmarks"))
+
+import fz_multi_layer_manager as mlm
+from fake_gimp import FakeGimp, FakeGroupLayer, FakeImage, FakeLayer, FakePdb
+
+def nested_image():
+    pdb = FakePdb()
+    mlm.gimp = FakeGimp(pdb)
+    image = FakeImage(pdb)
+    group = image.add(FakeGroupLayer(image, "bg_group", 20, 20))
+    image.add(FakeLayer(image, "bg_inner", 20, 20), group)
+    image.add(FakeLayer(image, "bg_top", 20, 20))
+    return pdb, image
+
+def test_matching_group_is_moved_once():
+    pdb, image = nested_image()
+    assert mlm.apply_operations(pdb, image, {'move': [5, 0]}) == 2
+    assert pdb.calls['gimp_layer_set_offsets'] == 2
+    assert image._top[0]._children[0]._offsets == (0, 0)
+
+def test_layers_inside_unmatched_groups_are_selected():
+    pdb, image = nested_image()
+    mlm.apply_operations(pdb, image, {'select': "bg_inner", 'opacity': 50})
+    assert image._top[0]._opacity == 100.0
+    assert image._top[0]._children[0]._opacity == 50.0
+
+def test_macro_changes_matching_groups_as_a_whole():
+    pdb, image = nested_image()
+    macro = {'steps': [{'select': "*"}, {'move': [5, 0]}, {'opacity': 50}, {'visible': 'toggle'}]}
+    assert mlm.replay_macro(pdb, image, macro) == 4
+    assert pdb.calls['gimp_layer_set_offsets'] == 2
+    inner = image._top[0]._children[0]
+    assert (inner._offsets, inner._opacity, inner._visible) == ((0, 0), 100.0, True)
+    assert image._top[0]._opacity == 50.0
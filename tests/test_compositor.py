@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""Checks of the NumPy compositor on plain arrays and of the NumPy layer actions."""
+
+import colorsys
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "benchmarks"))
+
+import fz_multi_layer_manager as mlm
+from fake_gimp import FakeGimp, FakeImage, FakeLayer, FakePdb
+
+def two_layer_image():
+    pdb = FakePdb()
+    mlm.gimp = FakeGimp(pdb)
+    image = FakeImage(pdb)
+    image.add(FakeLayer(image, "top", 8, 8))
+    image.add(FakeLayer(image, "bottom", 8, 8))
+    return pdb, image, mlm.LayerIndex(image)
+
+# Per-channel formulas of GIMP's legacy layer modes
+LEGACY_CHANNEL_BLENDS = {
+    "Normal": lambda b, s: s,
+    "Multiply": lambda b, s: b * s,
+    "Screen": lambda b, s: 1 - (1 - b) * (1 - s),
+    "Overlay": lambda b, s: b * (b + 2 * s * (1 - b)),
+    "Soft Light": lambda b, s: (1 - b) * b * s + b * (1 - (1 - b) * (1 - s)),
+    "Hard Light": lambda b, s: 2 * b * s if s <= 0.5 else 1 - (1 - b) * (1 - (s - 0.5) * 2),
+    "Color Dodge": lambda b, s: min(1.0, b / (1 - s)),
+    "Color Burn": lambda b, s: max(0.0, 1 - (1 - b) / s),
+    "Darken Only": min,
+    "Lighten Only": max,
+    "Addition": lambda b, s: min(1.0, b + s),
+    "Subtract": lambda b, s: max(0.0, b - s),
+    "Difference": lambda b, s: abs(b - s),
+}
+
+def legacy_blend(mode_name, b, s):
+    if mode_name in ("Hue", "Saturation", "Value"):
+        b_hsv, s_hsv = colorsys.rgb_to_hsv(*b), colorsys.rgb_to_hsv(*s)
+        index = ("Hue", "Saturation", "Value").index(mode_name)
+        hsv = list(b_hsv)
+        if mode_name != "Hue" or s_hsv[1]:
+            hsv[index] = s_hsv[index]
+        return colorsys.hsv_to_rgb(*hsv)
+    if mode_name == "Color":
+        s_hue, s_lightness, s_sat = colorsys.rgb_to_hls(*s)
+        return colorsys.hls_to_rgb(s_hue, colorsys.rgb_to_hls(*b)[1], s_sat)
+    return [LEGACY_CHANNEL_BLENDS[mode_name](x, y) for x, y in zip(b, s)]
+
+BACKDROP = [(0.2, 0.5, 0.8), (0.9, 0.1, 0.4), (0.5, 0.5, 0.5)]
+SOURCE = [(0.6, 0.3, 0.9), (0.1, 0.7, 0.2), (0.3, 0.8, 0.6)]
+
+def row(colors, alpha=1.0):
+    return mlm.numpy.array([[list(color) + [alpha] for color in colors]], mlm.numpy.float32)
+
+def test_layer_mode_values_follow_gimp():
+    assert mlm.LAYER_MODE_ADDITION_LEGACY == 7
+    assert mlm.LAYER_MODE_DARKEN_ONLY_LEGACY == 9
+    assert mlm.LAYER_MODE_HSV_VALUE_LEGACY == 14
+    assert mlm.LAYER_MODE_OVERLAY == 23
+    assert mlm.LAYER_MODE_NORMAL == 28
+    assert mlm.LAYER_MODE_SOFTLIGHT == 45
+    assert dict(mlm.BLEND_MODES)["Darken Only"] == mlm.LAYER_MODE_DARKEN_ONLY_LEGACY
+
+def test_gimp_2_10_modes_are_named_but_not_composited():
+    assert mlm.mode_name_of(mlm.LAYER_MODE_MULTIPLY) == "Multiply"
+    assert mlm.mode_name_of(mlm.LAYER_MODE_MULTIPLY_LEGACY) == "Multiply"
+    assert mlm.mode_name_of(mlm.LAYER_MODE_DISSOLVE) is None
+    assert mlm.composite_mode_of(mlm.LAYER_MODE_MULTIPLY_LEGACY) == "Multiply"
+    assert mlm.composite_mode_of(mlm.LAYER_MODE_MULTIPLY) is None
+    assert mlm.composite_mode_of(mlm.LAYER_MODE_NORMAL) == mlm.LINEAR_NORMAL
+
+@pytest.mark.parametrize("mode_name", [mode_name for mode_name, mode_value in mlm.BLEND_MODES])
+def test_blend_modes_match_gimp_legacy_formulas(mode_name):
+    stack = [(row(BACKDROP), (0, 0), 1.0, "Normal"), (row(SOURCE), (0, 0), 1.0, mode_name)]
+    canvas = mlm.composite_layers(stack, 3, 1)
+    expected = [list(legacy_blend(mode_name, b, s)) + [1.0] for b, s in zip(BACKDROP, SOURCE)]
+    assert mlm.numpy.allclose(canvas[0], expected, atol=1e-5)
+
+def test_legacy_modes_blend_only_into_the_backdrop():
+    backdrop = row(BACKDROP)
+    backdrop[0, 2, 3] = 0.0  # Transparent pixel
+    canvas = mlm.composite_layers([(backdrop, (0, 0), 1.0, "Normal"),
+                                   (row(SOURCE, 0.5), (0, 0), 0.5, "Multiply")], 3, 1)
+    multiplied = [b * s for b, s in zip(BACKDROP[0], SOURCE[0])]
+    assert mlm.numpy.allclose(canvas[0, 0, :3], [0.25 * m + 0.75 * b for m, b in zip(multiplied, BACKDROP[0])])
+    assert canvas[0, 0, 3] == 1.0
+    assert canvas[0, 2, 3] == 0.0
+
+def test_normal_modes_paint_over_transparency():
+    legacy = mlm.composite_layers([(row(SOURCE, 0.5), (0, 0), 1.0, "Normal")], 3, 1)
+    assert mlm.numpy.allclose(legacy[0], row(SOURCE, 0.5)[0])
+    black, white = row([(0.0, 0.0, 0.0)]), row([(1.0, 1.0, 1.0)])
+    linear = mlm.composite_layers([(black, (0, 0), 1.0, "Normal"),
+                                   (white, (0, 0), 0.5, mlm.LINEAR_NORMAL)], 1, 1)
+    assert abs(linear[0, 0, 0] - 0.7354) < 1e-3  # Half of the light, not half of the sRGB value
+
+def test_layers_are_clipped_to_the_canvas():
+    black = mlm.numpy.zeros((3, 4, 4), mlm.numpy.float32)
+    black[..., 3] = 1.0
+    white = mlm.numpy.ones((2, 2, 4), mlm.numpy.float32)
+    canvas = mlm.composite_layers([(black, (0, 0), 1.0, "Normal"), (white, (-1, 2), 1.0, "Normal"),
+                                   (white, (5, 0), 1.0, "Normal")], 4, 3)
+    assert mlm.numpy.argwhere(canvas[..., 0] > 0).tolist() == [[2, 0]]
+
+def test_mode_override_keeps_the_bottom_layer_normal():
+    stack = [(row(BACKDROP), (0, 0), 1.0, None), (row(SOURCE), (0, 0), 1.0, None)]
+    canvas = mlm.composite_layers(stack, 3, 1, "Multiply")
+    assert mlm.numpy.allclose(canvas[0, :, :3], row(BACKDROP)[0, :, :3] * row(SOURCE)[0, :, :3])
+
+def test_merge_refuses_unsupported_modes():
+    pdb, image, index = two_layer_image()
+    image._top[0]._mode = mlm.LAYER_MODE_MULTIPLY
+    with pytest.raises(ValueError, match="top"):
+        mlm.merge_to_new_layer(pdb, image, index, index.roots)
+    assert len(image._top) == 2
+
+def test_numpy_actions_refuse_without_numpy(monkeypatch):
+    pdb, image, index = two_layer_image()
+    monkeypatch.setattr(mlm, "numpy", None)
+    with pytest.raises(ValueError, match="NumPy"):
+        mlm.apply_operations(pdb, image, {'trim': True})
+    with pytest.raises(ValueError, match="NumPy"):
+        mlm.replay_macro(pdb, image, {'steps': [{'select': "*"}, {'trim': True}]})
+    with pytest.raises(ValueError, match="NumPy"):
+        mlm.merge_to_new_layer(pdb, image, index, index.roots)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+"""Checks of duplicate content detection against the PDB stand-in in benchmarks/."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "benchmarks"))
+
+import fz_multi_layer_manager as mlm
+from fake_gimp import FakeGimp, FakeImage, FakeLayer, FakePdb
+
+def test_retouched_copy_is_not_a_duplicate_on_rescan():
+    pdb = FakePdb()
+    mlm.gimp = FakeGimp(pdb)
+    image = FakeImage(pdb)
+    original = image.add(FakeLayer(image, "original", 16, 16))
+    copy = image.add(FakeLayer(image, "copy", 16, 16))
+    index = mlm.LayerIndex(image)
+    cache = mlm.ContentHashCache()
+    
+    groups, hashed = mlm.find_duplicate_content(pdb, image, index.roots, cache)
+    assert [[node.layer for node in group] for group in groups] == [[original, copy]]
+    
+    copy._retouch = 1  # Same size, offsets and thumbnail
+    groups, hashed = mlm.find_duplicate_content(pdb, image, index.roots, cache)
+    assert groups == []
+    assert hashed == 2
+    
+    groups, hashed = mlm.find_duplicate_content(pdb, image, index.roots, cache)
+    assert groups == [] and hashed == 0  # Unique hashes are trusted
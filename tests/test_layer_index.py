@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""Checks of LayerIndex against the in-memory PDB stand-in in benchmarks/."""
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "benchmarks"))
+
+import fz_multi_layer_manager as mlm
+from fake_gimp import FakeGimp, FakeGroupLayer, FakeImage, FakeLayer, FakePdb
+
+def make_image():
+    pdb = FakePdb()
+    mlm.gimp = FakeGimp(pdb)
+    return pdb, FakeImage(pdb)
+
+def assert_mirrors(index, image):
+    """Every loaded container of index matches the image, and no node is listed twice."""
+    seen = set()
+    
+    def check(nodes, items, parent):
+        assert [node.layer for node in nodes] == items
+        for position, node in enumerate(nodes):
+            assert node not in seen, "%r listed twice" % node.layer
+            seen.add(node)
+            assert node.parent is parent
+            assert node.position == position
+            if node.children is not None:
+                check(node.children, node.layer._children, node)
+    
+    check(index.roots, image._top, None)
+
+def test_group_of_group_and_its_child():
+    pdb, image = make_image()
+    group = image.add(FakeGroupLayer(image, "A"))
+    child = image.add(FakeLayer(image, "a1", 10, 10), group)
+    image.add(FakeLayer(image, "a2", 10, 10), group)
+    index = mlm.LayerIndex(image)
+    nodes = [index.roots[0], index.children(index.roots[0])[0]]
+    
+    mlm.group_layers(pdb, image, [node.layer for node in nodes])
+    index.refresh(set(node.parent for node in nodes) | set([None]))
+    list(index.walk())
+    
+    assert_mirrors(index, image)
+    assert index.by_tattoo[child._tattoo].parent.layer is image._top[0]
+
+def test_refresh_after_random_moves():
+    rng = random.Random(6)
+    for trial in range(200):
+        pdb, image = make_image()
+        groups = [None]
+        for number in range(12):
+            parent = rng.choice(groups)
+            if rng.random() < 0.3:
+                groups.append(image.add(FakeGroupLayer(image, "G%d" % number), parent))
+            else:
+                image.add(FakeLayer(image, "L%d" % number, 10, 10), parent)
+        index = mlm.LayerIndex(image)
+        for step in range(4):
+            # Load a random part of the tree, then group a random selection
+            for node in list(index.by_tattoo.values()):
+                if node.is_group and rng.random() < 0.5:
+                    index.children(node)
+            loaded = list(index.by_tattoo.values())
+            nodes = rng.sample(loaded, min(len(loaded), rng.randint(1, 3)))
+            containers = set(node.parent for node in nodes) | set([None])
+            # As the dialog does, a group and its children may both be moved
+            mlm.group_layers(pdb, image, [node.layer for node in sorted(nodes, key=mlm.LayerNode.path)])
+            index.refresh(containers)
+            list(index.walk())
+            assert_mirrors(index, image)
+
+def test_plan_reorder_reaches_target():
+    rng = random.Random(7)
+    for trial in range(500):
+        current = list(range(rng.randint(0, 12)))
+        rng.shuffle(current)
+        target = list(current)
+        rng.shuffle(target)
+        order = list(current)
+        for item, position in mlm.plan_reorder(current, target):
+            order.remove(item)
+            order.insert(position, item)
+        assert order == target
+
+def test_plan_reorder_moves_one_layer_for_a_block():
+    current = ["a", "b", "c", "d", "e"]
+    assert mlm.plan_reorder(current, ["a", "c", "d", "b", "e"]) == [("b", 3)]
+
+class FixedSnapshot(object):
+    def __init__(self, props):
+        self.props = props
+    
+    def get(self, node):
+        return self.props
+
+def test_compile_query():
+    pdb, image = make_image()
+    layer = image.add(FakeLayer(image, "bg_sky", 100, 40))
+    layer._visible = False
+    layer._opacity = 3.0
+    snapshot = FixedSnapshot(mlm.LayerProperties(pdb, layer))
+    node = mlm.LayerNode(None, 1, None, 0, 2, False)
+    
+    def matches(text):
+        return mlm.compile_query(text)(snapshot, node)
+    
+    assert matches("hidden opacity<5 bg_*")
+    assert not matches("visible")
+    assert matches("!group layer size>=100 depth=2")
+    assert not matches("'bg_s*' width>100")
+    assert matches("re:^bg_")
+
+def test_mode_query_matches_legacy_and_gimp_2_10_modes():
+    pdb, image = make_image()
+    modes = [mlm.LAYER_MODE_NORMAL, mlm.LAYER_MODE_NORMAL_LEGACY, mlm.LAYER_MODE_MULTIPLY,
+             mlm.LAYER_MODE_MULTIPLY_LEGACY, mlm.LAYER_MODE_SCREEN]
+    for number, mode in enumerate(modes):
+        image.add(FakeLayer(image, "layer %d" % number, 10, 10))._mode = mode
+    snapshot = mlm.PropertySnapshot(pdb, mlm.LayerIndex(image))
+    
+    def modes_matching(text):
+        return [snapshot.get(node).mode for node in snapshot.query(text)]
+    
+    assert sorted(modes_matching("mode:normal")) == [mlm.LAYER_MODE_NORMAL_LEGACY, mlm.LAYER_MODE_NORMAL]
+    assert sorted(modes_matching("mode:multiply")) == [mlm.LAYER_MODE_MULTIPLY_LEGACY, mlm.LAYER_MODE_MULTIPLY]
+    assert modes_matching("!mode:normal !mode:multiply") == [mlm.LAYER_MODE_SCREEN]
+
+def test_planning_reads_only_the_planned_properties():
+    pdb, image = make_image()
+    for i in range(3):
+        image.add(FakeLayer(image, "layer %d" % i, 10, 10))
+    index = mlm.LayerIndex(image)
+    pdb.calls.clear()
+    plan, skipped = mlm.plan_property_writes(mlm.PropertySnapshot(pdb, index), index.roots, {'opacity': 50.0})
+    assert len(plan) == 3
+    assert dict(pdb.calls) == {'gimp_layer_get_opacity': 3}
+
+def test_compile_query_errors():
+    for text in ("unknown:x", "re:(", "mode:nope"):
+        try:
+            mlm.compile_query(text)
+        except ValueError:
+            continue
+        raise AssertionError("%r was accepted" % text)